@@ -1,9 +1,10 @@
 import asyncio
-
-from collections import defaultdict
 import json
 import re
 
+from functools import lru_cache
+from itertools import groupby
+
 from cleo import Command
 from adbc.store import Database
 from adbc.config import get_config
@@ -12,9 +13,28 @@ try:
     import uvloop
 except ImportError:
     uvloop = None
+else:
+    # install once, so that programmatic callers using
+    # asyncio.run get uvloop too, not just the CLI commands
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
-
-COLLECTION_PERMISSION_REGEX = re.compile(r"/collection/([0-9]+)/(.*)")
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+COLLECTION_PERMISSION_PREFIX = "/collection/"
+DATABASE_KEY_REGEX = re.compile(r'"database"\s*:\s*(?:[0-9]+|null)')
+INSERT_BATCH_SIZE = 500
+QUERY_REFERENCE_KEYS = (
+    '"source-table"',
+    '"field-id"',
+    '"field"',
+    '"card_id"',
+    '"fingerprint"',
+)
+SLUG_TABLE = str.maketrans({char: "_" for char in "._()"})
 TABLES = {
     "card": "report_card",
     "question": "report_card",
@@ -40,11 +60,66 @@ def literal(X):
         return X
 
 
+def json_loads(value):
+    if orjson:
+        return orjson.loads(value)
+    return json.loads(value)
+
+
+def json_dumps(value):
+    if orjson:
+        # the driver expects text columns as str, not bytes
+        return orjson.dumps(value).decode()
+    return json.dumps(value)
+
+
 async def get_model(db, name):
-    return await db.get_model(TABLES.get(name, name))
+    models = db._cache["models"]
+    if name not in models:
+        models[name] = await db.get_model(TABLES.get(name, name))
+    return models[name]
+
+
+def batches(rows):
+    # keeps multi-row INSERTs under the driver's bind parameter limit
+    for start in range(0, len(rows), INSERT_BATCH_SIZE):
+        end = start + INSERT_BATCH_SIZE
+        yield rows[start:end]
+
+
+def source_ids(copied):
+    # source IDs of a {(source id, target): new id} map
+    return list({source_id for source_id, _ in copied})
+
+
+async def insert_rows(model, rows):
+    for batch in batches(rows):
+        await model.values(batch).add()
+
+
+async def insert_ids(model, rows):
+    # insert rows with as few statements as possible, returning new IDs in
+    # row order: callers map IDs back to source rows by position, which
+    # relies on INSERT ... RETURNING yielding rows in VALUES order; Postgres
+    # does this in practice but does not formally guarantee it
+    ids = []
+    for batch in batches(rows):
+        result = await model.values(batch).take("id").add()
+        # a single-row insert comes back as a record, not a list
+        if not isinstance(result, list):
+            result = [result]
+        if len(result) != len(batch):
+            raise ValueError(
+                f"Expected {len(batch)} IDs from {model.table.name} insert, "
+                f"got {len(result)}"
+            )
+        ids.extend(r["id"] for r in result)
+    return ids
 
 
 async def reset_sequences(db):
+    # one SELECT with a setval per table instead of a statement each
+    setvals = []
     for model in (
         "collection",
         "card",
@@ -58,129 +133,152 @@ async def reset_sequences(db):
         schema = table.namespace.name
         pk = table.pk
         seq = f"{table.name}_id_seq"
-        await db.execute(
-            f"SELECT setval('{schema}.{seq}',"
+        setvals.append(
+            f"setval('{schema}.{seq}',"
             f'(SELECT COALESCE(MAX("{pk}"), 1) + 100 FROM "{table.name}"))'
         )
+    await db.execute(f"SELECT {', '.join(setvals)}")
 
 
 async def drop_collections(
-    db, databases, root_collection_id, base_collection_id, only=None
+    db, environment_collections, root_collection_id, base_collection_id, only=None
 ):
     # no longer deleting permissions
-    Collection = await get_model(db, "collection")
-    Card = await get_model(db, "card")
-    Dashboard = await get_model(db, "dashboard")
-    DashboardCard = await get_model(db, "dashboard_card")
-    CardSeries = await get_model(db, "card_series")
-
-    where = {
-        "and": [
-            {"like": ["location", f"'/{root_collection_id}/%'"]},
-            {
-                "not": {
-                    "like": [
-                        "location",
-                        f"'/{root_collection_id}/{base_collection_id}/%'",
-                    ]
-                }
-            },
-            {"not": {"=": ["id", base_collection_id]}},
-        ]
-    }
     # collection_ids - get cloned collection ids
-    # and all of their descendant IDs
-    collections = await Collection.where(where).take("id", "name").get()
-    collection_ids = [c["id"] for c in collections if should_process(c["name"], only)]
+    # and all of their descendant IDs, from the already-loaded
+    # environment tree rather than another SELECT
+    base_location = f"/{root_collection_id}/{base_collection_id}/"
+    collection_ids = [
+        c["id"]
+        for c in environment_collections
+        if c["id"] != base_collection_id
+        and not c["location"].startswith(base_location)
+        and should_process(c["name"], only)
+    ]
     if not collection_ids:
         return
 
-    card_ids = (
-        await Card.where({"in": ["collection_id", collection_ids]}).field("id").get()
-    )
-    dashboard_ids = (
-        await Dashboard.where({"in": ["collection_id", collection_ids]})
-        .field("id")
-        .get()
-    )
-    dashboardcard_ids = (
-        await DashboardCard.where({"in": ["dashboard_id", dashboard_ids]})
-        .field("id")
-        .get()
-    )
-    other_dashboardcard_ids = (
-        await DashboardCard.where({"in": ["card_id", card_ids]}).field("id").get()
-    )
-    cardseries_ids = (
-        await CardSeries.where({"in": ["dashboardcard_id", dashboardcard_ids]})
-        .field("id")
-        .get()
+    # one statement instead of a SELECT + DELETE per table; foreign keys
+    # are checked at the end of the statement, so CTE order is irrelevant
+    ids = ", ".join(str(c) for c in collection_ids)
+    await db.execute(
+        f"""
+        WITH cards AS (
+            SELECT id FROM "{TABLES['card']}" WHERE collection_id IN ({ids})
+        ), dashboards AS (
+            SELECT id FROM "{TABLES['dashboard']}" WHERE collection_id IN ({ids})
+        ), dashboardcards AS (
+            SELECT id FROM "{TABLES['dashboard_card']}"
+            WHERE dashboard_id IN (SELECT id FROM dashboards)
+            OR card_id IN (SELECT id FROM cards)
+        ), deleted_series AS (
+            DELETE FROM "{TABLES['card_series']}"
+            WHERE dashboardcard_id IN (SELECT id FROM dashboardcards)
+            OR card_id IN (SELECT id FROM cards)
+        ), deleted_dashboardcards AS (
+            DELETE FROM "{TABLES['dashboard_card']}"
+            WHERE id IN (SELECT id FROM dashboardcards)
+        ), deleted_dashboards AS (
+            DELETE FROM "{TABLES['dashboard']}" WHERE id IN (SELECT id FROM dashboards)
+        ), deleted_cards AS (
+            DELETE FROM "{TABLES['card']}" WHERE id IN (SELECT id FROM cards)
+        )
+        DELETE FROM "{TABLES['collection']}" WHERE id IN ({ids})
+        """
     )
-    if cardseries_ids:
-        await CardSeries.where({"in": ["id", cardseries_ids]}).delete()
-    if dashboardcard_ids:
-        await DashboardCard.where({"in": ["id", dashboardcard_ids]}).delete()
-    if other_dashboardcard_ids:
-        await DashboardCard.where({"in": ["id", other_dashboardcard_ids]}).delete()
-    if dashboard_ids:
-        await Dashboard.where({"in": ["id", dashboard_ids]}).delete()
-    if card_ids:
-        await Card.where({"in": ["id", card_ids]}).delete()
-    if collection_ids:
-        await Collection.where({"in": ["id", collection_ids]}).delete()
 
 
 async def permissions_for(Permissions, collection_ids):
-    permissions = await Permissions.where({"like": ["object", "'/collection/%'"]}).get()
-    return [
-        p for p in permissions if any([f"/{c}/" in p["object"] for c in collection_ids])
-    ]
+    # let the database filter down to these collections' permissions
+    # rather than shipping every collection permission back
+    if not collection_ids:
+        return []
+    return await Permissions.where(
+        {
+            "or": [
+                {"like": ["object", f"'{COLLECTION_PERMISSION_PREFIX}{c}/%'"]}
+                for c in collection_ids
+            ]
+        }
+    ).get()
 
 
-def remap_permissions(permission, collections):
+def remap_permissions(permission, databases, collections):
+    # e.g. "/collection/123/read/" -> 123, "read/"
+    obj = permission["object"]
+    if not obj.startswith(COLLECTION_PERMISSION_PREFIX):
+        raise ValueError(f"not a collection permission: {obj}")
+    prefix_length = len(COLLECTION_PERMISSION_PREFIX)
+    collection_id, _, remainder = obj[prefix_length:].partition("/")
+    base = dict(permission)
+    base.pop("id", None)
     permissions = []
-    collection = COLLECTION_PERMISSION_REGEX.match(permission["object"])
-    collection_id = int(collection.group(1))
-    remainder = collection.group(2)
-    collections = collections[collection_id]
-    for target, new_id in collections.items():
-        new_permission = dict(permission.items())
-        new_permission["object"] = f"/collection/{new_id}/{remainder}"
-        new_permission.pop("id")
+    collection_id = int(collection_id)
+    for target in databases:
+        new_id = collections[(collection_id, target)]
+        new_permission = dict(base)
+        new_permission["object"] = f"{COLLECTION_PERMISSION_PREFIX}{new_id}/{remainder}"
         permissions.append(new_permission)
     return permissions
 
 
-async def copy_permissions(db, collections, verbose=False):
+async def copy_permissions(db, databases, collections, verbose=False):
     Permissions = await get_model(db, "permissions")
-    collection_ids = collections.keys()
+    collection_ids = source_ids(collections)
     permissions = await permissions_for(Permissions, collection_ids)
+    new_permissions = []
     for permission in permissions:
         if verbose:
             print(f"Copying permission#{permission['id']}...")
-        new_permissions = remap_permissions(permission, collections)
-        if new_permissions:
-            await Permissions.values(new_permissions).add()
+        new_permissions.extend(remap_permissions(permission, databases, collections))
+    await insert_rows(Permissions, new_permissions)
 
 
 async def copy_collections(
     db, databases, base, collections, cards, dashboards, verbose=False
 ):
     Collection = await get_model(db, "collection")
-    for collection in sorted(base, key=lambda x: x["location"].count("/")):
-        collection_id = collection["id"]
-        for target in databases.keys():
-            new_collection = await remap_collection(
-                db, collection, target, collections, databases
-            )
-            new_collection = await Collection.values([new_collection]).take("id").add()
-            collections[collection_id][target] = new_collection["id"]
+    # load the items of every source collection up front: two queries
+    # instead of two per collection; each card query is parsed once here
+    # and the tables and fields they reference are resolved in bulk
+    collection_ids = [collection["id"] for collection in base]
+    source_cards = {
+        collection_id: [(card, parse_query(card["dataset_query"])) for card in items]
+        for collection_id, items in (
+            await items_by_collection(db, "card", collection_ids)
+        ).items()
+    }
+    source_dashboards = await items_by_collection(db, "dashboard", collection_ids)
+    await prefetch_refs(
+        db,
+        [query for items in source_cards.values() for _, query in items],
+        databases,
+    )
+    # siblings do not depend on each other, so each depth level is
+    # inserted in one statement; parents are always one level up
+    for _, level in groupby(sorted(base, key=collection_depth), key=collection_depth):
+        level = list(level)
+        new_collections = [
+            await remap_collection(db, collection, target, collections, databases)
+            for collection in level
+            for target in databases
+        ]
+        new_ids = iter(await insert_ids(Collection, new_collections))
+        level_cards = []
+        level_dashboards = []
+        for collection in level:
+            collection_id = collection["id"]
+            for target in databases:
+                collections[(collection_id, target)] = next(new_ids)
+            if verbose:
+                print(f"Copying collection #{collection_id}...")
+            level_cards.extend(source_cards.get(collection_id, []))
+            level_dashboards.extend(source_dashboards.get(collection_id, []))
 
-        if verbose:
-            print(f"Copying collection #{collection_id}...")
         await copy_collection_items(
             db,
-            collection_id,
+            level_cards,
+            level_dashboards,
             databases,
             collections,
             cards,
@@ -189,98 +287,178 @@ async def copy_collections(
         )
 
 
+def collection_depth(collection):
+    return collection["location"].count("/")
+
+
 async def copy_card(db, card, databases, cards=None, collections=None):
-    Card = await get_model(db, "card")
-    card_id = card["id"]
-    for target in databases.keys():
-        new_card = await remap_card(
-            db, card, target, cards=cards, collections=collections
-        )
-        new_card = await Card.values([new_card]).take("id").add()
-        if cards is not None:
-            cards[card_id][target] = new_card["id"]
-    return new_card["id"]
+    query = parse_query(card["dataset_query"])
+    copied = await insert_cards(db, [(card, query)], databases, cards, collections)
+    return copied[(card["id"], list(databases)[-1])]
 
 
-async def copy_dashboard(db, dashboard, databases, collections, dashboards):
-    Dashboard = await get_model(db, "dashboard")
-    dashboard_id = dashboard["id"]
-    for target in databases.keys():
-        new_dashboard = await remap_dashboard(db, dashboard, target, collections)
-        new_dashboard = await Dashboard.values([new_dashboard]).take("id").add()
-        dashboards[dashboard_id][target] = new_dashboard["id"]
+def card_refs(query):
+    # IDs of other cards that an MBQL query depends on
+    tables, _, card_ids = collect_refs(query)
+    for table in tables:
+        if isinstance(table, str) and table.startswith("card__"):
+            card_ids.add(int(table.replace("card__", "")))
+    return card_ids
 
 
-async def copy_collection_items(
-    db, collection_id, databases, collections, cards, dashboards, verbose=False
-):
+async def insert_cards(db, batch, databases, cards=None, collections=None):
+    # `batch` holds (card, parse_query result) pairs; remap_query does not
+    # mutate its input, so one parse serves every target
     Card = await get_model(db, "card")
-    Dashboard = await get_model(db, "dashboard")
-
-    for card in (
-        await Card.where({"=": ["collection_id", collection_id]}).sort("id").get()
-    ):
+    new_cards = [
+        await remap_card(
+            db, card, target, query, cards=cards, collections=collections
+        )
+        for card, query in batch
+        for target in databases
+    ]
+    new_ids = iter(await insert_ids(Card, new_cards))
+    copied = {}
+    for card, _ in batch:
+        for target in databases:
+            copied[(card["id"], target)] = next(new_ids)
+    if cards is not None:
+        cards.update(copied)
+    return copied
+
+
+async def copy_cards(db, source_cards, databases, cards, collections, verbose=False):
+    # `source_cards` holds (card, parse_query result) pairs;
+    # insert cards in as few statements as possible; a batch is only cut
+    # when a card is based on another card that is still in the batch
+    batch = []
+    batch_ids = set()
+    for card, query in source_cards:
         if verbose:
             print(f"Copying card #{card['id']}...")
-        await copy_card(db, card, databases, cards=cards, collections=collections)
-    for dashboard in (
-        await Dashboard.where({"=": ["collection_id", collection_id]}).sort("id").get()
-    ):
+        if query is not None and card_refs(query) & batch_ids:
+            await insert_cards(db, batch, databases, cards, collections)
+            batch = []
+            batch_ids = set()
+        batch.append((card, query))
+        batch_ids.add(card["id"])
+    if batch:
+        await insert_cards(db, batch, databases, cards, collections)
+
+
+async def copy_dashboards(
+    db, source_dashboards, databases, collections, dashboards, verbose=False
+):
+    Dashboard = await get_model(db, "dashboard")
+    new_dashboards = []
+    for dashboard in source_dashboards:
         if verbose:
             print(f"Copying dashboard #{dashboard['id']}...")
-        await copy_dashboard(db, dashboard, databases, collections, dashboards)
+        for target in databases:
+            new_dashboards.append(
+                await remap_dashboard(db, dashboard, target, collections)
+            )
+    new_ids = iter(await insert_ids(Dashboard, new_dashboards))
+    for dashboard in source_dashboards:
+        for target in databases:
+            dashboards[(dashboard["id"], target)] = next(new_ids)
+
+
+async def items_by_collection(db, name, collection_ids):
+    items = {}
+    if not collection_ids:
+        return items
+    model = await get_model(db, name)
+    rows = await model.where({"in": ["collection_id", collection_ids]}).sort("id").get()
+    for row in rows:
+        items.setdefault(row["collection_id"], []).append(row)
+    return items
+
+
+async def copy_collection_items(
+    db,
+    source_cards,
+    source_dashboards,
+    databases,
+    collections,
+    cards,
+    dashboards,
+    verbose=False,
+):
+    await copy_cards(
+        db, source_cards, databases, cards, collections, verbose=verbose,
+    )
+    await copy_dashboards(
+        db, source_dashboards, databases, collections, dashboards, verbose=verbose,
+    )
 
 
 async def remap_cardseries(db, link, target, dashboardcards, cards):
-    link = dict(link.items())
+    link = dict(link)
+    old_card_id = link["card_id"]
     try:
-        link["card_id"] = cards[link["card_id"]][target]
-    except:
-        import pdb
-
-        pdb.set_trace()
-        raise
-    link["dashboardcard_id"] = dashboardcards[link["dashboardcard_id"]][target]
-    link.pop("id")
+        link["card_id"] = cards[(old_card_id, target)]
+    except KeyError:
+        raise ValueError(f"Failed to remap cardseries on source card: {old_card_id}")
+    link["dashboardcard_id"] = dashboardcards[(link["dashboardcard_id"], target)]
+    link.pop("id", None)
     return link
 
 
 async def copy_cardseries(db, databases, dashboardcards, cards, verbose=False):
     Series = await get_model(db, "card_series")
+    new_links = []
     for link in await Series.where(
-        {"in": ["dashboardcard_id", list(dashboardcards.keys())]}
+        {"in": ["dashboardcard_id", source_ids(dashboardcards)]}
     ).get():
         if verbose:
             print(f"Copying cardseries#{link['id']}...")
         for target in databases.keys():
-            new_link = await remap_cardseries(db, link, target, dashboardcards, cards)
-            await Series.values([new_link]).add()
+            new_links.append(
+                await remap_cardseries(db, link, target, dashboardcards, cards)
+            )
+    # series rows are not referenced by anything else,
+    # so they can all go in together
+    await insert_rows(Series, new_links)
 
 
 async def copy_dashboardcards(
     db, databases, dashboards, cards, dashboardcards, verbose=False
 ):
     DashboardCard = await get_model(db, "dashboard_card")
-    for link in await DashboardCard.where(
-        {"in": ["dashboard_id", list(dashboards.keys())]}
-    ).get():
-        link_id = link["id"]
+    links = await DashboardCard.where(
+        {"in": ["dashboard_id", source_ids(dashboards)]}
+    ).get()
+    new_links = []
+    for link in links:
         if verbose:
             print(f"Copying dashboardcard#{link['id']}...")
-        for target in databases.keys():
-            new_link = await remap_dashboardcard(db, link, target, dashboards, cards)
-            new_link = await DashboardCard.values([new_link]).take("id").add()
-            dashboardcards[link_id][target] = new_link["id"]
+        # remap_query does not mutate its input,
+        # so one parse serves every target
+        query = parse_query(link["parameter_mappings"])
+        for target in databases:
+            new_links.append(
+                await remap_dashboardcard(db, link, target, query, dashboards, cards)
+            )
+
+    new_ids = iter(await insert_ids(DashboardCard, new_links))
+    for link in links:
+        for target in databases:
+            dashboardcards[(link["id"], target)] = next(new_ids)
+
+
+def location_parts(location):
+    return tuple(int(part) for part in location.split("/") if part)
 
 
 def remap_collection_location(location, target, collections):
-    parts = [l for l in location.split("/") if l]
+    parts = list(location_parts(location))
     can_fail = True
     # try to remap each segment
     for i in range(len(parts)):
-        part = int(parts[i])
-        if part in collections:
-            parts[i] = collections[part][target]
+        part = parts[i]
+        if (part, target) in collections:
+            parts[i] = collections[(part, target)]
             # once a segment is remapped, all other segments
             # must be remappable
             can_fail = False
@@ -292,17 +470,22 @@ def remap_collection_location(location, target, collections):
     return result
 
 
+@lru_cache(maxsize=4096)
 def slugify(name):
-    for char in (".", "_", "(", ")"):
-        name = name.replace(char, "_")
-    return name
+    return name.translate(SLUG_TABLE)
 
 
 async def remap_collection(db, collection, target, collections, databases):
-    collection = dict(collection.items())
-    collection["location"] = remap_collection_location(
-        collection["location"], target, collections
-    )
+    collection = dict(collection)
+    # siblings share a location, and ancestors are always copied
+    # before their descendants, so the result is stable within a run
+    locations = db._cache["locations"]
+    key = (collection["location"], target)
+    if key not in locations:
+        locations[key] = remap_collection_location(
+            collection["location"], target, collections
+        )
+    collection["location"] = locations[key]
     if collection["location"].count("/") == 2:
         new_name = databases[target]
         name = collection["name"]
@@ -314,36 +497,41 @@ async def remap_collection(db, collection, target, collections, databases):
     return collection
 
 
-async def remap_dashboardcard(db, link, target, dashboards, cards):
-    link = dict(link.items())
+async def remap_dashboardcard(db, link, target, query, dashboards, cards):
+    # `query` is the parse_query result for the link's parameter_mappings
+    link = dict(link)
     # map card/dashboard_id over
     old_card_id = link["card_id"]
     if old_card_id:
         try:
-            link["card_id"] = cards[old_card_id][target]
+            link["card_id"] = cards[(old_card_id, target)]
         except KeyError:
             raise ValueError(
                 f"Failed to remap dashboardcard on source card: {old_card_id}"
             )
-    link["dashboard_id"] = dashboards[link["dashboard_id"]][target]
+    link["dashboard_id"] = dashboards[(link["dashboard_id"], target)]
 
-    query = json.loads(link["parameter_mappings"])
-    query = await remap_query(db, query, target, cards)
-
-    link["parameter_mappings"] = json.dumps(query)
+    if query is not None:
+        query = await remap_query(db, query, target, cards)
+        link["parameter_mappings"] = json_dumps(query)
+    # otherwise (e.g. no mappings) the raw JSON is copied as is
     link.pop("id", None)
     return link
 
 
 async def remap_dashboard(db, dashboard, target, collections):
-    dashboard = dict(dashboard.items())
+    dashboard = dict(dashboard)
     dashboard.pop("id", None)
     collection_id = dashboard["collection_id"]
-    dashboard["collection_id"] = collections[collection_id][target]
+    dashboard["collection_id"] = collections[(collection_id, target)]
     return dashboard
 
 
 async def remap_field(db, field_id, target, cards):
+    remapped = db._cache["fields_by_target"]
+    if (field_id, target) in remapped:
+        return remapped[(field_id, target)]
+
     Field = await get_model(db, "field")
     if field_id not in db._cache["fields_by_id"]:
         field = await Field.take("name", "table_id").get(field_id)
@@ -352,41 +540,49 @@ async def remap_field(db, field_id, target, cards):
     field = db._cache["fields_by_id"][field_id]
     target_table = await remap_table(db, field["table_id"], target, cards=cards)
 
+    fields_by_name = db._cache["fields_by_name"]
     key = (target_table, field["name"])
-    if key not in db._cache["fields_by_name"]:
-        db._cache["fields_by_name"][key] = (
-            await Field.where(
-                {
-                    "and": [
-                        {"=": ["name", literal(field["name"])]},
-                        {"=": ["table_id", target_table]},
-                    ]
-                }
+    if key not in fields_by_name:
+        # load the whole target table in one query
+        # so that its other fields resolve from the cache
+        for f in (
+            await Field.where({"=": ["table_id", target_table]})
+            .take("id", "name")
+            .get()
+        ):
+            fields_by_name.setdefault((target_table, f["name"]), f["id"])
+        if key not in fields_by_name:
+            raise ValueError(
+                f"Failed to remap source field: {field_id} ({field['name']}) "
+                f"to table#{target_table} in db#{target}"
             )
-            .field("id")
-            .one()
-        )
 
-    return db._cache["fields_by_name"][key]
+    remapped[(field_id, target)] = fields_by_name[key]
+    return remapped[(field_id, target)]
 
 
 async def remap_table(db, table_id, target, cards=None):
+    remapped = db._cache["tables_by_target"]
+    if (table_id, target) in remapped:
+        return remapped[(table_id, target)]
+
     Table = await get_model(db, "table")
     if isinstance(table_id, str) and table_id.startswith("card__"):
         card_id = int(table_id.replace("card__", ""))
         if cards is not None:
             # assume this card was already remapped and exists in `cards`
             try:
-                new_id = cards[card_id][target]
+                new_id = cards[(card_id, target)]
             except KeyError:
                 print(
                     f"error resolving card#{card_id} while remapping table: {table_id} "
                     f"to DB#{target}"
                 )
-                if card_id in cards:
-                    print(f"(cards[{card_id}] = {cards[card_id]})")
+                copied = {t: new for (c, t), new in cards.items() if c == card_id}
+                if copied:
+                    print(f"(cards[{card_id}] = {copied})")
                 else:
-                    print(f"(cards = {list(cards.keys())})")
+                    print(f"(cards = {source_ids(cards)})")
                 raise
         else:
             # recursively copy this card
@@ -394,7 +590,7 @@ async def remap_table(db, table_id, target, cards=None):
             card = await Card.key(card_id).one()
             new_id = await copy_card(db, card, {target: 1})
 
-        return f"card__{new_id}"
+        new_table = f"card__{new_id}"
     else:
         if table_id not in db._cache["tables_by_id"]:
             db._cache["tables_by_id"][table_id] = await Table.take(
@@ -403,100 +599,270 @@ async def remap_table(db, table_id, target, cards=None):
         table = db._cache["tables_by_id"][table_id]
         schema = table["schema"]
         name = table["name"]
+        tables_by_name = db._cache["tables_by_name"]
         key = (target, schema, name)
-        if key not in db._cache["tables_by_name"]:
-            db._cache["tables_by_name"][key] = (
-                await Table.where(
-                    {
-                        "and": [
-                            {"=": ["schema", literal(schema)]},
-                            {"=": ["name", literal(name)]},
-                            {"=": ["db_id", target]},
-                        ]
-                    }
+        if key not in tables_by_name:
+            # load every table of the target database in one query
+            # so that its other tables resolve from the cache
+            for t in (
+                await Table.where({"=": ["db_id", target]})
+                .take("id", "schema", "name")
+                .get()
+            ):
+                tables_by_name.setdefault((target, t["schema"], t["name"]), t["id"])
+            if key not in tables_by_name:
+                raise ValueError(
+                    f"Failed to remap source table: {table_id} ({schema}.{name}) "
+                    f"to db#{target}"
                 )
-                .field("id")
-                .one()
-            )
-        return db._cache["tables_by_name"][key]
+        new_table = tables_by_name[key]
+
+    remapped[(table_id, target)] = new_table
+    return new_table
+
+
+def has_references(raw):
+    # cheap check on the raw JSON for anything beyond the top-level
+    # "database" that remap_query would need to rewrite
+    return raw.count('"database"') > 1 or any(
+        key in raw for key in QUERY_REFERENCE_KEYS
+    )
+
+
+def parse_query(raw):
+    # the parsed query if remap_query has anything to rewrite in it,
+    # or None if the raw JSON can be copied with at most a database patch
+    return json_loads(raw) if has_references(raw) else None
+
+
+def is_field_ref(query):
+    # ['field-id', 123] or ['field', 123, {'join': ...}]
+    return len(query) in {2, 3} and (query[0] == "field" or query[0] == "field-id")
+
+
+def collect_refs(query):
+    """Collect the table, field, and card IDs referenced by an MBQL query"""
+    tables, fields, cards = set(), set(), set()
+    stack = [query]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, list):
+            if is_field_ref(node):
+                fields.add(node[1])
+            else:
+                stack.extend(node)
+        elif isinstance(node, dict):
+            for key, value in node.items():
+                if key == "source-table":
+                    tables.add(value)
+                elif key == "card_id":
+                    if value is not None:
+                        cards.add(value)
+                elif key not in {"database", "fingerprint"}:
+                    stack.append(value)
+    return tables, fields, cards
+
+
+def rewrite_query(query, target, tables, fields, cards):
+    """Rebuild an MBQL query for `target` from resolved ID maps"""
+    result = [None]
+    stack = [(query, result, 0)]
+    while stack:
+        node, parent, index = stack.pop()
+        if isinstance(node, list):
+            if is_field_ref(node):
+                parent[index] = [node[0], fields[node[1]], *node[2:]]
+            else:
+                new_node = list(node)
+                parent[index] = new_node
+                stack.extend((value, new_node, i) for i, value in enumerate(node))
+        elif isinstance(node, dict):
+            new_node = dict(node)
+            parent[index] = new_node
+            for key, value in node.items():
+                if key == "database":
+                    new_node[key] = target
+                elif key == "source-table":
+                    new_node[key] = tables[value]
+                elif key == "fingerprint":
+                    new_node[key] = None
+                elif key == "card_id":
+                    if value is not None:
+                        new_node[key] = cards[value]
+                else:
+                    stack.append((value, new_node, key))
+        else:
+            parent[index] = node
+    return result[0]
 
 
 async def remap_query(db, query, target, cards=None):
-    if isinstance(query, list):
-        # special case handling for array segments that represent field hybrids
-        if len(query) in {2,3} and (query[0] == 'field' or query[0] == 'field-id'):
-            # ['field-id', 123] or ['field', 123, {'join': ...}]
-            field = await remap_field(db, query[1], target, cards=cards)
-            return [query[0], field, *query[2:]]
+    table_ids, field_ids, card_ids = collect_refs(query)
+
+    # once warm, references resolve straight from the (id, target) memos;
+    # only misses pay for a remap_table/remap_field coroutine
+    remapped_tables = db._cache["tables_by_target"]
+    tables = {}
+    for table_id in table_ids:
+        if (table_id, target) in remapped_tables:
+            tables[table_id] = remapped_tables[(table_id, target)]
+            continue
+        try:
+            tables[table_id] = await remap_table(db, table_id, target, cards=cards)
+        except KeyError:
+            print(f"error remapping table during remap_query {query}")
+            raise
+
+    remapped_fields = db._cache["fields_by_target"]
+    fields = {}
+    for field_id in field_ids:
+        if (field_id, target) in remapped_fields:
+            fields[field_id] = remapped_fields[(field_id, target)]
         else:
-            return [await remap_query(db, q, target, cards=cards) for q in query]
-    elif isinstance(query, dict):
-        result = {}
-        for key, value in query.items():
-            new_value = value
-            if key == "database":
-                new_value = target
-            elif key == "source-table":
-                try:
-                    new_value = await remap_table(db, value, target, cards=cards)
-                except KeyError:
-                    print(f"error remapping table during remap_query {query}")
-                    raise
-            elif key == "fingerprint":
-                new_value = None
-            elif key == "card_id":
-                if value is not None:
-                    if cards is not None:
-                        new_value = cards[value][target]
-                    else:
-                        Card = await get_model(db, "card")
-                        card = await Card.key(card_id).one()
-                        new_value = await copy_card(db, card, {target: 1})
-            else:
-                new_value = await remap_query(db, value, target, cards=cards)
-            result[key] = new_value
-        query = result
+            fields[field_id] = await remap_field(db, field_id, target, cards=cards)
 
-    return query
+    new_cards = {}
+    for card_id in card_ids:
+        if cards is not None:
+            new_cards[card_id] = cards[(card_id, target)]
+        else:
+            Card = await get_model(db, "card")
+            card = await Card.key(card_id).one()
+            new_cards[card_id] = await copy_card(db, card, {target: 1})
 
+    return rewrite_query(query, target, tables, fields, new_cards)
 
-async def remap_card(db, card, target, cards=None, collections=None):
-    card = dict(card.items())
-    query = json.loads(card["dataset_query"])
-    try:
-        query = await remap_query(db, query, target, cards=cards)
-    except Exception:
-        print(f'error remapping card#{card["id"]} to db#{target}')
-        raise
 
-    card["dataset_query"] = json.dumps(query)
+async def remap_card(db, card, target, query, cards=None, collections=None):
+    # `query` is the parse_query result for the card's dataset_query
+    card = dict(card)
+    if query is not None:
+        try:
+            query = await remap_query(db, query, target, cards=cards)
+        except Exception:
+            print(f'error remapping card#{card["id"]} to db#{target}')
+            raise
+        card["dataset_query"] = json_dumps(query)
+    else:
+        # e.g. a native query: only the database needs to change,
+        # so patch the raw JSON without a parse/dump round trip
+        card["dataset_query"] = DATABASE_KEY_REGEX.sub(
+            f'"database": {target}', card["dataset_query"], count=1
+        )
     if collections:
-        card["collection_id"] = collections[card["collection_id"]][target]
-    card.pop("id")
+        card["collection_id"] = collections[(card["collection_id"], target)]
+    card.pop("id", None)
     return card
 
 
+def parse_only(only):
+    # "a, B" -> ("a ", "b "): lowercased name prefixes for should_process
+    if not only:
+        return ()
+    return tuple(f"{o.strip().lower()} " for o in only.split(","))
+
+
 def should_process(name, only):
     if not only:
         return True
 
-    name = name.lower()
-    for o in only:
-        o = o.strip().lower()
-        if name.startswith(f"{o} ") or name == o:
-            return True
-    return False
+    # matches names equal to an entry or starting with "<entry> "
+    return f"{name.lower()} ".startswith(only)
 
 
 def setup_cache(db):
     db._cache = {
+        "models": {},
+        "locations": {},
         "fields_by_id": {},
         "fields_by_name": {},
         "tables_by_name": {},
         "tables_by_id": {},
+        # (source id, target database) -> remapped id
+        "fields_by_target": {},
+        "tables_by_target": {},
     }
 
 
+async def prefetch_refs(db, queries, targets=()):
+    # load the source tables/fields referenced by `queries`, and their
+    # counterparts in each of `targets`, with a few bulk queries
+    # instead of one SELECT per reference
+    Table = await get_model(db, "table")
+    Field = await get_model(db, "field")
+    cache = db._cache
+    table_ids, field_ids = set(), set()
+    for query in queries:
+        if query is None:
+            # nothing to resolve, see parse_query
+            continue
+        query_tables, query_fields, _ = collect_refs(query)
+        table_ids.update(t for t in query_tables if isinstance(t, int))
+        field_ids.update(f for f in query_fields if isinstance(f, int))
+
+    missing_field_ids = field_ids - cache["fields_by_id"].keys()
+    if missing_field_ids:
+        fields = (
+            await Field.where({"in": ["id", list(missing_field_ids)]})
+            .take("id", "name", "table_id")
+            .get()
+        )
+        for field in fields:
+            cache["fields_by_id"][field["id"]] = field
+    table_ids.update(
+        cache["fields_by_id"][f]["table_id"]
+        for f in field_ids
+        if f in cache["fields_by_id"]
+    )
+
+    table_ids.difference_update(cache["tables_by_id"])
+    if table_ids:
+        tables = (
+            await Table.where({"in": ["id", list(table_ids)]})
+            .take("id", "name", "schema")
+            .get()
+        )
+        for table in tables:
+            cache["tables_by_id"][table["id"]] = table
+
+    if not targets:
+        return
+
+    tables_by_name = cache["tables_by_name"]
+    tables = (
+        await Table.where({"in": ["db_id", list(targets)]})
+        .take("id", "schema", "name", "db_id")
+        .get()
+    )
+    for table in tables:
+        tables_by_name.setdefault(
+            (table["db_id"], table["schema"], table["name"]), table["id"]
+        )
+
+    # the target tables that referenced fields will be looked up in
+    target_table_ids = set()
+    for field_id in field_ids:
+        field = cache["fields_by_id"].get(field_id)
+        table = field and cache["tables_by_id"].get(field["table_id"])
+        if not table:
+            continue
+        for target in targets:
+            key = (target, table["schema"], table["name"])
+            if key in tables_by_name:
+                target_table_ids.add(tables_by_name[key])
+
+    if target_table_ids:
+        fields = (
+            await Field.where({"in": ["table_id", list(target_table_ids)]})
+            .take("id", "name", "table_id")
+            .get()
+        )
+        for field in fields:
+            cache["fields_by_name"].setdefault(
+                (field["table_id"], field["name"]), field["id"]
+            )
+
+
 def get_database(verbose=False, prompt=False, config=None, url=None):
     # -vv or -vvv should add database logging, but not -v
     verbose = verbose and verbose > 1
@@ -509,6 +875,24 @@ def get_database(verbose=False, prompt=False, config=None, url=None):
     return Database(**connection_kwargs)
 
 
+async def get_target_database(db, database):
+    # {id: name} for the database whose name is or starts with `database`
+    DB = await get_model(db, "database")
+    target_database = (
+        await DB.take("id", "name")
+        .where(
+            {
+                "or": [
+                    {"like": ["name", f'"{database}%"']},
+                    {"=": ["name", literal(database)]},
+                ]
+            }
+        )
+        .one()
+    )
+    return {target_database["id"]: target_database["name"]}
+
+
 async def copy_collection(
     collection,
     database,
@@ -521,34 +905,22 @@ async def copy_collection(
     db = get_database(verbose=verbose, prompt=prompt, config=config, url=url)
     setup_cache(db)
     Collection = await get_model(db, "collection")
-    DB = await get_model(db, "database")
 
     collection_id = int(collection)
-    source_collection = await Collection.key(collection_id).one()
+    source_collection, databases = await asyncio.gather(
+        Collection.key(collection_id).one(), get_target_database(db, database)
+    )
+    (target_database_id,) = databases
     source_location = source_collection["location"]
     source_collections = await Collection.where(
         {"like": ["location", f'"{source_location}{collection_id}/%"']}
     ).get()
     source_collections.append(source_collection)
 
-    target_database = (
-        await DB.take("id", "name")
-        .where(
-            {
-                "or": [
-                    {"like": ["name", f'"{database}%"']},
-                    {"=": ["name", literal(database)]},
-                ]
-            }
-        )
-        .one()
-    )
-    target_database_id = target_database["id"]
-    databases = {target_database_id: target_database["name"]}
-    collections = defaultdict(dict)
-    cards = defaultdict(dict)
-    dashboards = defaultdict(dict)
-    dashboardcards = defaultdict(dict)
+    collections = {}
+    cards = {}
+    dashboards = {}
+    dashboardcards = {}
 
     new_id = None
     connection = await db.get_connection()
@@ -557,11 +929,11 @@ async def copy_collection(
         await copy_collections(
             db, databases, source_collections, collections, cards, dashboards
         )
-        await copy_permissions(db, collections)
+        await copy_permissions(db, databases, collections)
         await copy_dashboardcards(db, databases, dashboards, cards, dashboardcards)
         await copy_cardseries(db, databases, dashboardcards, cards)
 
-        new_id = collections[collection_id][target_database_id]
+        new_id = collections[(collection_id, target_database_id)]
         if verbose:
             num_cards = len(cards)
             num_subcollections = len(collections) - 1
@@ -584,25 +956,15 @@ async def copy_question(
     db = get_database(verbose=verbose, prompt=prompt, config=config, url=url)
     setup_cache(db)
     Card = await get_model(db, "card")
-    DB = await get_model(db, "database")
 
     question = int(question)
-    source_card = await Card.key(question).one()
-    target_database = (
-        await DB.take("id", "name")
-        .where(
-            {
-                "or": [
-                    {"like": ["name", f'"{database}%"']},
-                    {"=": ["name", literal(database)]},
-                ]
-            }
-        )
-        .one()
+    source_card, databases = await asyncio.gather(
+        Card.key(question).one(), get_target_database(db, database)
     )
-
-    databases = {target_database["id"]: target_database["name"]}
-    new_id = await copy_card(db, source_card, databases)
+    query = parse_query(source_card["dataset_query"])
+    await prefetch_refs(db, [query], databases)
+    copied = await insert_cards(db, [(source_card, query)], databases)
+    (new_id,) = copied.values()
     if verbose:
         print(f"new card ID: {new_id}")
     return new_id
@@ -648,13 +1010,18 @@ async def copy(
     """
     db = get_database(verbose=verbose, prompt=prompt, config=config, url=url)
     setup_cache(db)
-    connection = await db.get_connection()
-    db.use(connection)
 
     DB = await get_model(db, "database")
     Collection = await get_model(db, "collection")
 
-    databases = await DB.take("id", "name").get()
+    # these reads are independent and happen before the copy connection
+    # is pinned, so each can run on its own pooled connection
+    databases, root_collection_id = await asyncio.gather(
+        DB.take("id", "name").get(),
+        Collection.field("id")
+        .where({"and": [{"=": ["location", "'/'"]}, {"=": ["name", literal(alls)]}]})
+        .one(),
+    )
     base = base.lower()
     base_database_id = None
     base_name = f"{base} "
@@ -668,47 +1035,52 @@ async def copy(
     if not base_database_id:
         raise ValueError(f'No base database named "{base}"')
 
-    if only:
-        only = only.split(",")
+    only = parse_only(only)
 
     databases = {
         r["id"]: r["name"]
         for r in databases
         if r["id"] != base_database_id and should_process(r["name"], only)
     }
-    root_collection_id = (
-        await Collection.field("id")
-        .where({"and": [{"=": ["location", "'/'"]}, {"=": ["name", literal(alls)]}]})
-        .one()
-    )
-    base_collection = await Collection.where(
-        {
-            "and": [
-                {"like": ["location", f"'/{root_collection_id}/%'"]},
-                {
-                    "or": [
-                        {"ilike": ["name", literal(base_name)]},
-                        {"=": ["name", literal(base)]},
-                    ]
-                },
-            ]
-        }
-    ).one()
-    base_collection_id = base_collection["id"]
-    base_collections = await Collection.where(
-        {"like": ["location", f"'/{root_collection_id}/{base_collection_id}/%'"]}
+    # fetch the whole environment tree in one query,
+    # then pick out the base collection and its descendants
+    root_location = f"/{root_collection_id}/"
+    environment_collections = await Collection.where(
+        {"like": ["location", f"'{root_location}%'"]}
     ).get()
+    base_collection = None
+    for row in environment_collections:
+        if row["location"] != root_location:
+            continue
+        name = row["name"].lower()
+        if name.startswith(base_name) or name == base:
+            if base_collection:
+                raise ValueError(f'found collection conflicts for "{base}"')
+            base_collection = row
+
+    if not base_collection:
+        raise ValueError(f'No base collection named "{base}"')
+
+    base_collection_id = base_collection["id"]
+    base_location = f"{root_location}{base_collection_id}/"
+    base_collections = [
+        row
+        for row in environment_collections
+        if row["location"].startswith(base_location)
+    ]
     base_collections.append(base_collection)
 
-    collections = defaultdict(dict)
-    cards = defaultdict(dict)
-    dashboards = defaultdict(dict)
-    dashboardcards = defaultdict(dict)
+    collections = {}
+    cards = {}
+    dashboards = {}
+    dashboardcards = {}
+    connection = await db.get_connection()
+    db.use(connection)
     async with connection.transaction():
         if verbose:
             print("Dropping collections...")
         await drop_collections(
-            db, databases, root_collection_id, base_collection_id, only
+            db, environment_collections, root_collection_id, base_collection_id, only
         )
         if verbose:
             print("Resetting sequences...")
@@ -726,7 +1098,7 @@ async def copy(
         )
         if verbose:
             print("Copying permissions...")
-        # await copy_permissions(db, collections, verbose=verbose)
+        # await copy_permissions(db, databases, collections, verbose=verbose)
         if verbose:
             print("Copying dashboardcards...")
         await copy_dashboardcards(
@@ -739,6 +1111,14 @@ async def copy(
             raise Exception("rollback transaction")
 
 
+def run(coroutine):
+    if uvloop and hasattr(uvloop, "run"):
+        # uvloop >= 0.18 ships its own runner
+        return uvloop.run(coroutine)
+    # otherwise the policy installed at import time applies
+    return asyncio.run(coroutine)
+
+
 class CopyCollection(Command):
     """Copies Metabase Collection + sub-collections + Questions + Dashboards
 
@@ -752,8 +1132,6 @@ class CopyCollection(Command):
     """
 
     def handle(self):
-        if uvloop:
-            uvloop.install()
         collection = self.argument("collection")
         database = self.argument("database")
         rollback = self.option("rollback")
@@ -761,7 +1139,7 @@ class CopyCollection(Command):
         prompt = self.option("prompt")
         url = self.option("url")
         verbose = self.option("verbose")
-        asyncio.run(
+        run(
             copy_collection(
                 collection,
                 database,
@@ -787,8 +1165,6 @@ class CopyQuestion(Command):
     """
 
     def handle(self):
-        if uvloop:
-            uvloop.install()
         question = self.argument("question")
         database = self.argument("database")
         rollback = self.option("rollback")
@@ -796,7 +1172,7 @@ class CopyQuestion(Command):
         prompt = self.option("prompt")
         url = self.option("url")
         verbose = self.option("verbose")
-        asyncio.run(
+        run(
             copy_question(
                 question,
                 database,
@@ -822,8 +1198,6 @@ class Copy(Command):
     """
 
     def handle(self):
-        if uvloop:
-            uvloop.install()
         base = self.option("base")
         alls = self.option("all")
         config = self.option("config")
@@ -839,7 +1213,7 @@ class Copy(Command):
                 verbose = 0
         prompt = self.option("prompt")
         only = self.option("only")
-        asyncio.run(
+        run(
             copy(
                 alls,
                 base,
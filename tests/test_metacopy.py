@@ -1,5 +1,152 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
 from metacopy import __version__
 
 
+@pytest.fixture
+def command():
+    # needs the runtime dependencies (adbc, cleo) to be installed
+    return pytest.importorskip("metacopy.command")
+
+
+@pytest.fixture
+def db(command):
+    # remap_query only touches the database on cache misses,
+    # so a warm cache stands in for it
+    db = SimpleNamespace()
+    command.setup_cache(db)
+    db._cache["tables_by_target"].update({(5, 9): 50, ("card__7", 9): "card__70"})
+    db._cache["fields_by_target"].update({(10, 9): 100, (11, 9): 110})
+    return db
+
+
+QUERY = {
+    "database": 1,
+    "type": "query",
+    "query": {
+        "source-query": {
+            "source-table": "card__7",
+            "filter": ["=", ["field-id", 10], "x"],
+        },
+        "joins": [
+            {
+                "source-table": 5,
+                "condition": ["=", ["field", 11, {"join-alias": "a"}], ["field", 10]],
+            }
+        ],
+        "fingerprint": {"type": ["field-id", 99]},
+    },
+}
+
+
 def test_version():
     assert __version__ == '0.1.0'
+
+
+def test_collect_refs(command):
+    tables, fields, cards = command.collect_refs(QUERY)
+    assert tables == {5, "card__7"}
+    # fingerprints are dropped, not walked
+    assert fields == {10, 11}
+    assert cards == set()
+
+
+def test_card_refs(command):
+    query = {"source-table": "card__7", "card_id": 3}
+    assert command.card_refs(query) == {3, 7}
+    assert command.card_refs({"card_id": None}) == set()
+
+
+def test_remap_query(command, db):
+    original = json.loads(json.dumps(QUERY))
+    remapped = asyncio.run(command.remap_query(db, QUERY, 9, cards={}))
+    assert remapped == {
+        "database": 9,
+        "type": "query",
+        "query": {
+            "source-query": {
+                "source-table": "card__70",
+                "filter": ["=", ["field-id", 100], "x"],
+            },
+            "joins": [
+                {
+                    "source-table": 50,
+                    "condition": [
+                        "=",
+                        ["field", 110, {"join-alias": "a"}],
+                        ["field", 100],
+                    ],
+                }
+            ],
+            "fingerprint": None,
+        },
+    }
+    assert QUERY == original
+
+
+def test_remap_query_parameter_mappings(command, db):
+    mappings = [
+        {"card_id": 3, "target": ["dimension", ["field-id", 10]]},
+        {"card_id": None, "target": ["dimension", ["field", 11, None]]},
+    ]
+    remapped = asyncio.run(command.remap_query(db, mappings, 9, cards={(3, 9): 30}))
+    assert remapped == [
+        {"card_id": 30, "target": ["dimension", ["field-id", 100]]},
+        {"card_id": None, "target": ["dimension", ["field", 110, None]]},
+    ]
+
+
+def test_has_references(command):
+    native = '{"database": 1, "type": "native", "native": {"query": "select 1"}}'
+    assert not command.has_references(native)
+    assert not command.has_references("[]")
+    assert command.has_references(json.dumps(QUERY))
+    assert command.has_references('{"database": 1, "fingerprint": null}')
+    assert command.parse_query(native) is None
+    assert command.parse_query(json.dumps(QUERY)) == QUERY
+
+
+def test_remap_card_native(command, db):
+    raw = '{"database": 1, "type": "native", "native": {"query": "select 1"}}'
+    card = {"id": 4, "collection_id": 2, "dataset_query": raw}
+    remapped = asyncio.run(
+        command.remap_card(
+            db, card, 9, command.parse_query(raw), collections={(2, 9): 20}
+        )
+    )
+    assert remapped == {
+        "collection_id": 20,
+        "dataset_query": (
+            '{"database": 9, "type": "native", "native": {"query": "select 1"}}'
+        ),
+    }
+
+
+def test_should_process(command):
+    only = command.parse_only("Foo, bar baz")
+    assert command.should_process("foo", only)
+    assert command.should_process("FOO Staging", only)
+    assert command.should_process("Bar Baz", only)
+    assert not command.should_process("foobar", only)
+    assert not command.should_process("bar", only)
+    assert command.parse_only(None) == ()
+    assert command.should_process("anything", command.parse_only(""))
+
+
+def test_remap_permissions(command):
+    permission = {"id": 1, "object": "/collection/12/read/", "group_id": 2}
+    collections = {(12, 5): 120, (12, 6): 121}
+    assert command.remap_permissions(permission, {5: "a", 6: "b"}, collections) == [
+        {"object": "/collection/120/read/", "group_id": 2},
+        {"object": "/collection/121/read/", "group_id": 2},
+    ]
+    permission = {"id": 1, "object": "/collection/12/", "group_id": 2}
+    assert command.remap_permissions(permission, {5: "a"}, collections) == [
+        {"object": "/collection/120/", "group_id": 2}
+    ]
+    with pytest.raises(ValueError):
+        command.remap_permissions({"object": "/db/1/"}, {5: "a"}, collections)